@@ -3,8 +3,6 @@
 import logging
 import re
 from collections import OrderedDict
-from csv import DictReader
-from itertools import chain, groupby
 
 from multiqc import config
 from multiqc.plots import table
@@ -28,6 +26,10 @@ FIELD_DESCRIPTIONS = {
     "TUMOR_AWARENESS": "Whether this pairwise comparison was flagged for tumor awareness",
 }
 
+# Options of interest in the Picard CLI invocation stored in the file header
+TUMOR_AWARENESS_RE = re.compile(r"CALCULATE_TUMOR_AWARE_RESULTS(\s|=)(\w+)")
+LOD_THRESHOLD_RE = re.compile(r"LOD_THRESHOLD(\s|=)(\S+)")
+
 
 def parse_reports(module):
     """
@@ -37,34 +39,65 @@ def parse_reports(module):
     does pairwise comparisons between samples at the level selected by `--CROSSCHECK_BY`.
     """
 
-    data_by_sample = dict()
+    data_by_sample = []
+    # Table layout flags, tracked while parsing so the rows don't need to be walked again
+    any_tumor_awareness = False
+    all_samples_are_groups = True
 
     # Go through logs and find Metrics
     for f in module.find_log_files("picard/crosscheckfingerprints", filehandles=True):
         # Parse an individual CrosscheckFingerprints Report
-        (metrics, comments) = _take_till(f["f"], lambda line: line.startswith("#") or line == "\n")
-        header = next(metrics).rstrip("\n").split("\t")
+        (comments, header_line, metrics) = _take_till(f["f"], lambda line: line.startswith("#") or line == "\n")
+        if header_line is None:
+            # Nothing but comments
+            continue
+        header = header_line.rstrip("\n").split("\t")
         if "LEFT_GROUP_VALUE" not in header:
             # Not a CrosscheckFingerprints Report
             continue
-        reader = DictReader(metrics, fieldnames=header, delimiter="\t")
         # Parse out the tumor awareness option and the lod threshold setting if possible
         tumor_awareness, lod_threshold = _parse_cli(comments[1])
-        for i, row in enumerate(reader):
-            # Check if this row contains samples that should be ignored
-            if module.is_ignore_sample(row["LEFT_SAMPLE"]) or module.is_ignore_sample(row["RIGHT_SAMPLE"]):
+
+        # Every sample is compared against every other one, so the same names recur
+        # across many rows. Cache the per-name work for this file.
+        clean_names = dict()
+        ignored_names = dict()
+
+        def clean_s_name(name):
+            if name not in clean_names:
+                clean_names[name] = module.clean_s_name(name, f)
+            return clean_names[name]
+
+        def is_ignore_sample(name):
+            if name not in ignored_names:
+                ignored_names[name] = module.is_ignore_sample(name)
+            return ignored_names[name]
+
+        rows = (line.rstrip("\r\n").split("\t") for line in metrics if line.strip())
+        left_idx = header.index("LEFT_SAMPLE")
+        right_idx = header.index("RIGHT_SAMPLE")
+        for fields in rows:
+            # Check if this row contains samples that should be ignored, before building the row
+            if is_ignore_sample(fields[left_idx]) or is_ignore_sample(fields[right_idx]):
                 continue
 
+            row = dict(zip(header, fields))
+
             # Clean the sample names
-            row["LEFT_SAMPLE"] = module.clean_s_name(row["LEFT_SAMPLE"], f)
-            row["LEFT_GROUP_VALUE"] = module.clean_s_name(row["LEFT_GROUP_VALUE"], f)
-            row["RIGHT_SAMPLE"] = module.clean_s_name(row["RIGHT_SAMPLE"], f)
-            row["RIGHT_GROUP_VALUE"] = module.clean_s_name(row["RIGHT_GROUP_VALUE"], f)
+            row["LEFT_SAMPLE"] = clean_s_name(row["LEFT_SAMPLE"])
+            row["LEFT_GROUP_VALUE"] = clean_s_name(row["LEFT_GROUP_VALUE"])
+            row["RIGHT_SAMPLE"] = clean_s_name(row["RIGHT_SAMPLE"])
+            row["RIGHT_GROUP_VALUE"] = clean_s_name(row["RIGHT_GROUP_VALUE"])
 
             # Set the cli options of interest for this file
             row["LOD_THRESHOLD"] = lod_threshold
             row["TUMOR_AWARENESS"] = tumor_awareness
-            data_by_sample[i] = row
+            data_by_sample.append(row)
+
+            any_tumor_awareness = any_tumor_awareness or bool(tumor_awareness)
+            all_samples_are_groups = all_samples_are_groups and (
+                row["LEFT_SAMPLE"] == row["LEFT_GROUP_VALUE"] and row["RIGHT_SAMPLE"] == row["RIGHT_GROUP_VALUE"]
+            )
 
             module.add_data_source(f, section="CrosscheckFingerprints")
 
@@ -76,8 +109,11 @@ def parse_reports(module):
     # Replace None with actual version if it is available
     module.add_software_version(None)
 
+    # Reports and plots expect a dict, so key the pairwise comparisons by row number
+    data_by_row = dict(enumerate(data_by_sample))
+
     # Write data to file
-    module.write_data_file(data_by_sample, f"{module.anchor}_crosscheckfingerprints")
+    module.write_data_file(data_by_row, f"{module.anchor}_crosscheckfingerprints")
 
     # For each sample, flag if any comparisons that don't start with "Expected"
     # A sample that does not have all "Expected" will show as `False` and be Red
@@ -99,8 +135,8 @@ def parse_reports(module):
         Checks that all data in the set of input files comes from the same individual, based on the selected group granularity.
         """,
         plot=table.plot(
-            data_by_sample,
-            _get_table_headers(data_by_sample),
+            data_by_row,
+            _get_table_headers(any_tumor_awareness, all_samples_are_groups),
             {
                 "namespace": module.name,
                 "id": f"{module.anchor}_crosscheckfingerprints_table",
@@ -119,41 +155,41 @@ def _take_till(iterator, fn):
     """
     Take from an iterator till `fn` returns false.
 
-    Returns the iterator with the value that caused false at the front, and all the lines skipped till then as a list.
+    Returns all the lines skipped till then as a list, the value that caused false (or None if the
+    iterator ran out first), and the iterator positioned just after that value.
     """
     headers = []
-    try:
-        val = next(iterator)
-        while fn(val):
-            headers.append(val)
-            val = next(iterator)
-    except StopIteration:
-        return ()
+    for val in iterator:
+        if not fn(val):
+            return headers, val, iterator
+        headers.append(val)
 
-    return chain([val], iterator), headers
+    return headers, None, iterator
 
 
 def _parse_cli(line):
     """Parse the Picard CLI invocation that is stored in the header section of the file."""
-    tumor_awareness_regex = r"CALCULATE_TUMOR_AWARE_RESULTS(\s|=)(\w+)"
-    lod_threshold_regex = r"LOD_THRESHOLD(\s|=)(\S+)"
-
     tumor_awareness = None
     lod_threshold = None
 
-    tumor_awareness_match = re.search(tumor_awareness_regex, line)
+    tumor_awareness_match = TUMOR_AWARENESS_RE.search(line)
     if tumor_awareness_match is not None:
         tumor_awareness = strtobool(tumor_awareness_match.group(2))
 
-    lod_threshold_match = re.search(lod_threshold_regex, line)
+    lod_threshold_match = LOD_THRESHOLD_RE.search(line)
     if lod_threshold_match is not None:
         lod_threshold = float(lod_threshold_match.group(2))
 
     return tumor_awareness, lod_threshold
 
 
-def _get_table_headers(data_by_sample):
-    """Create the headers config"""
+def _get_table_headers(any_tumor_awareness, all_samples_are_groups):
+    """
+    Create the headers config.
+
+    `any_tumor_awareness` is whether any pair had the tumor awareness flag set, and
+    `all_samples_are_groups` whether every pair's sample names match their group values.
+    """
 
     table_cols = [
         "RESULT",
@@ -181,7 +217,7 @@ def _get_table_headers(data_by_sample):
     table_cols_hidden = picard_config.get("CrosscheckFingerprints_table_cols_hidden", table_cols_hidden)
 
     # Add the Tumor/Normal LOD scores if any pair had the tumor_awareness flag set
-    if any(row["TUMOR_AWARENESS"] for row in data_by_sample.values()):
+    if any_tumor_awareness:
         table_cols += [
             "LOD_SCORE_TUMOR_NORMAL",
             "LOD_SCORE_NORMAL_TUMOR",
@@ -193,10 +229,7 @@ def _get_table_headers(data_by_sample):
         ]
 
     # Add Left and Right Sample names / groups, keeping it as minimal as possible
-    def sample_group_are_same(x):
-        return x["LEFT_SAMPLE"] == x["LEFT_GROUP_VALUE"] and x["RIGHT_SAMPLE"] == x["RIGHT_GROUP_VALUE"]
-
-    if all(sample_group_are_same(values) for values in data_by_sample.values()):
+    if all_samples_are_groups:
         table_cols = [
             "LEFT_SAMPLE",
             "RIGHT_SAMPLE",
@@ -251,12 +284,13 @@ def _create_general_stats_data(in_data):
     Look at the LEFT_SAMPLE fields and determine if there are any pairs for that samples
     that don't have a RESULT that startswith EXPECTED.
     """
-    out_data = dict()
-    flattened = (row for row in in_data.values())
-    sorted_by_left_sample = sorted(flattened, key=lambda r: r["LEFT_SAMPLE"])
-
-    for group, values in groupby(sorted_by_left_sample, key=lambda r: r["LEFT_SAMPLE"]):
-        passfail = "Pass" if all(v["RESULT"].startswith("EXPECTED") for v in values) else "Fail"
-        out_data[group] = {"Crosschecks All Expected": passfail}
-
-    return out_data
+    all_expected = dict()
+    for row in in_data:
+        left_sample = row["LEFT_SAMPLE"]
+        expected = row["RESULT"].startswith("EXPECTED")
+        all_expected[left_sample] = all_expected.get(left_sample, True) and expected
+
+    return {
+        s_name: {"Crosschecks All Expected": "Pass" if all_expected[s_name] else "Fail"}
+        for s_name in sorted(all_expected)
+    }